@@ -36,6 +36,10 @@ logging.basicConfig(filename='server.log',level=logging.DEBUG)
 #  1   muted: uint8
 BINARY_USER_CONFIG_FORMAT = struct.Struct(">Q32sffHB")
 
+# big-endian
+#  2   number of users: uint16
+BINARY_USER_SUMMARY_HEADER_FORMAT = struct.Struct(">H")
+
 FRAME_SIZE = 128
 
 N_IMAGINARY_USERS = 0  # for debugging user summary + mixing console performance
@@ -102,7 +106,7 @@ class State():
 
         self.leader = None
 
-        self.backing_track: Any = np.zeros(0)
+        self.backing_track: Any = np.zeros(0, np.float32)
         self.backing_track_index = 0
         self.backing_track_type = ""
 
@@ -158,15 +162,22 @@ USER_INACTIVE_SAMPLES = SAMPLE_RATE * 5  # 5s
 # Force rounding to multiple of FRAME_SIZE
 QUEUE_LENGTH = (QUEUE_SECONDS * SAMPLE_RATE // FRAME_SIZE * FRAME_SIZE)
 
-audio_queue = np.zeros(QUEUE_LENGTH, np.float32)
-backing_queue = np.zeros(QUEUE_LENGTH, np.float32)
-monitor_queue = np.zeros(QUEUE_LENGTH, np.float32)
+# The float32 queues are rows of a single array, ordered so that queues we
+#   always touch together are adjacent and can be handled in one operation:
+#   monitor and audio are cleared together, audio and backing are read
+#   together.
+MONITOR_ROW, AUDIO_ROW, BACKING_ROW = range(3)
+mix_queues = np.zeros((3, QUEUE_LENGTH), np.float32)
+monitor_queue = mix_queues[MONITOR_ROW]
+audio_queue = mix_queues[AUDIO_ROW]
+backing_queue = mix_queues[BACKING_ROW]
+monitor_and_audio_queues = mix_queues[MONITOR_ROW:AUDIO_ROW+1]
+audio_and_backing_queues = mix_queues[AUDIO_ROW:BACKING_ROW+1]
+
 n_people_queue = np.zeros(QUEUE_LENGTH, np.int16)
 
 def clear_whole_buffer():
-    audio_queue.fill(0)
-    backing_queue.fill(0)
-    monitor_queue.fill(0)
+    mix_queues.fill(0)
     n_people_queue.fill(0)
 
 # For volume scaling.
@@ -255,9 +266,11 @@ class Recorder:
             n_samples = QUEUE_LENGTH
 
         if n_samples > 0:
+            data, backing_data = wrap_get(
+                audio_and_backing_queues, begin, n_samples)
             self.write_(fix_volume(
-                wrap_get(audio_queue, begin, n_samples),
-                wrap_get(backing_queue, begin, n_samples),
+                data,
+                backing_data,
                 wrap_get(n_people_queue, begin, n_samples)))
             self.last_clock += n_samples
 
@@ -420,36 +433,85 @@ def sendall(key, value, exclude=None):
         if not exclude or user.userid not in exclude:
             user.send(key, value)
 
-def wrap_get(queue, start, len_vals) -> Any:
-    start_in_queue = start % len(queue)
-
-    if start_in_queue + len_vals <= len(queue):
-        return np.copy(queue[start_in_queue:(start_in_queue+len_vals)])
+# All of these take a queue whose last axis is QUEUE_LENGTH long (a single
+#   queue, or several stacked rows of mix_queues), and a run of at most
+#   QUEUE_LENGTH samples starting at the clock position `start`, which wraps
+#   around the end of the queue at most once.  The length check matters: a
+#   longer run can still split into two slices of matching sizes, which
+#   numpy would accept, silently overlapping the run with itself.
+
+def wrap_get(queue, start, len_vals, out=None) -> Any:
+    assert len_vals <= QUEUE_LENGTH
+    if out is None:
+        out = np.empty(queue.shape[:-1] + (len_vals,), queue.dtype)
+    start_in_queue = start % QUEUE_LENGTH
+    end_in_queue = start_in_queue + len_vals
+
+    if end_in_queue <= QUEUE_LENGTH:
+        out[...] = queue[..., start_in_queue:end_in_queue]
     else:
-        second_section_size = (start_in_queue + len_vals) % len(queue)
-        first_section_size = len_vals - second_section_size
-        assert second_section_size > 0
-        assert first_section_size > 0
-
-        return np.concatenate([
-            queue[start_in_queue:(start_in_queue+first_section_size)],
-            queue[0:second_section_size]
-            ])
+        first_section_size = QUEUE_LENGTH - start_in_queue
+        out[..., :first_section_size] = queue[..., start_in_queue:]
+        out[..., first_section_size:] = queue[..., :end_in_queue - QUEUE_LENGTH]
+    return out
 
 def wrap_assign(queue, start, vals) -> None:
-    assert len(vals) <= len(queue)
-    start_in_queue = start % len(queue)
+    assert vals.shape[-1] <= QUEUE_LENGTH
+    start_in_queue = start % QUEUE_LENGTH
+    end_in_queue = start_in_queue + vals.shape[-1]
+
+    if end_in_queue <= QUEUE_LENGTH:
+        queue[..., start_in_queue:end_in_queue] = vals
+    else:
+        first_section_size = QUEUE_LENGTH - start_in_queue
+        queue[..., start_in_queue:] = vals[..., :first_section_size]
+        queue[..., :end_in_queue - QUEUE_LENGTH] = vals[..., first_section_size:]
+
+def wrap_zero(queue, start, len_vals) -> None:
+    assert len_vals <= QUEUE_LENGTH
+    start_in_queue = start % QUEUE_LENGTH
+    end_in_queue = start_in_queue + len_vals
 
-    if start_in_queue + len(vals) <= len(queue):
-        queue[start_in_queue:(start_in_queue+len(vals))] = vals
+    if end_in_queue <= QUEUE_LENGTH:
+        queue[..., start_in_queue:end_in_queue] = 0
     else:
-        second_section_size = (start_in_queue + len(vals) )% len(queue)
-        first_section_size = len(vals) - second_section_size
-        assert second_section_size > 0
-        assert first_section_size > 0
+        queue[..., start_in_queue:] = 0
+        queue[..., :end_in_queue - QUEUE_LENGTH] = 0
 
-        queue[start_in_queue:(start_in_queue+first_section_size)] = vals[:first_section_size]
-        queue[0:second_section_size] = vals[first_section_size:]
+def wrap_add(queue, start, vals) -> None:
+    assert vals.shape[-1] <= QUEUE_LENGTH
+    start_in_queue = start % QUEUE_LENGTH
+    end_in_queue = start_in_queue + vals.shape[-1]
+
+    if end_in_queue <= QUEUE_LENGTH:
+        queue[..., start_in_queue:end_in_queue] += vals
+    else:
+        first_section_size = QUEUE_LENGTH - start_in_queue
+        queue[..., start_in_queue:] += vals[..., :first_section_size]
+        queue[..., :end_in_queue - QUEUE_LENGTH] += vals[..., first_section_size:]
+
+# Buffers for the read path in handle_post, reused across requests instead
+#   of allocating fresh ones every time.  This is safe because requests are
+#   handled one at a time, and handle_post copies the result into the
+#   response (after the user summary) before returning it.
+#
+# n_samples is chosen by the client, so the buffers have a fixed capacity:
+#   as many float32 samples as the shm path can carry.  Larger requests get
+#   fresh arrays, which are freed afterwards as usual.
+MAX_SCRATCH_SAMPLES = 199998 // 4  # keep in sync with shm.py:MAX_DATA_LENGTH
+scratch_buffers: Dict[str, Any] = {}
+
+def get_scratch(name, n_samples, dtype, n_rows=1) -> Any:
+    if n_samples > MAX_SCRATCH_SAMPLES:
+        buf = np.empty(n_rows * n_samples, dtype)
+    else:
+        buf = scratch_buffers.get(name)
+        if buf is None:
+            buf = scratch_buffers[name] = np.empty(
+                n_rows * MAX_SCRATCH_SAMPLES, dtype)
+    if n_rows == 1:
+        return buf[:n_samples]
+    return buf[:n_rows * n_samples].reshape(n_rows, n_samples)
 
 def run_backing_track() -> None:
     if state.requested_track in tracks:
@@ -465,8 +527,9 @@ def run_backing_track() -> None:
                     "wrong sample rate on %s" % state.requested_track)
 
             state.backing_track = np.frombuffer(
-                inf.readframes(-1), np.int16).astype(np.float32) / (2**15)
-            state.backing_track *= 0.8 # turn it down a bit
+                inf.readframes(-1), np.int16).astype(np.float32)
+            # Scale to [-1, 1) and turn it down a bit, in a single pass.
+            state.backing_track *= 0.8 / (2**15)
             state.backing_track_index = 0
             state.backing_track_type = "Backing Track"
 
@@ -634,7 +697,8 @@ def user_summary(requested_user_summary) -> List[Any]:
     return summary
 
 def summary_length(n_users_in_summary):
-    return 2 + BINARY_USER_CONFIG_FORMAT.size*n_users_in_summary
+    return (BINARY_USER_SUMMARY_HEADER_FORMAT.size +
+            BINARY_USER_CONFIG_FORMAT.size*n_users_in_summary)
 
 def binary_user_summary(summary):
     """
@@ -647,7 +711,7 @@ def binary_user_summary(summary):
     Each user is 60 bytes, so 1000 users is ~50k.  We could be more
     compact by only sending names if they have changed.
     """
-    binary_summaries = [struct.pack(">H", len(summary))]
+    binary_summaries = [BINARY_USER_SUMMARY_HEADER_FORMAT.pack(len(summary))]
     for delay, name, mic_volume, userid, rms_volume, muted, is_monitored in summary:
         # delay is encoded as a uint16
         if delay < 0:
@@ -703,18 +767,13 @@ def backfill_metronome():
     write_metronome(state.song_start_clock, state.last_cleared_clock - state.song_start_clock)
 
 def update_audio(pos, n_samples, in_data, is_monitored):
-    old_audio = wrap_get(audio_queue, pos, n_samples)
-    new_audio = old_audio + in_data
-    wrap_assign(audio_queue, pos, new_audio)
+    wrap_add(audio_queue, pos, in_data)
 
     if is_monitored:
-        wrap_assign(monitor_queue,
-                    pos,
-                    wrap_get(monitor_queue, pos, n_samples) + in_data)
+        wrap_add(monitor_queue, pos, in_data)
 
-    old_n_people = wrap_get(n_people_queue, pos, n_samples)
-    new_n_people = old_n_people + np.ones(n_samples, np.int16)
-    wrap_assign(n_people_queue, pos, new_n_people)
+    # A broadcast view, so this doesn't allocate n_samples ones.
+    wrap_add(n_people_queue, pos, np.broadcast_to(np.int16(1), n_samples))
 
 def repeat_length_samples():
     beat_length_s = 60 / state.bpm
@@ -730,14 +789,25 @@ def fix_volume(data, backing_data, n_people, user_backing_volume=1.0):
     # Compare:
     #   https://www.wolframalpha.com/input/?i=graph+%281%29+%2F+%28x%29+from+1+to+10
     #   https://www.wolframalpha.com/input/?i=graph+%281%2B3%29+%2F+%28x%2B3%29+from+1+to+10
+    #
+    # The gain is computed in float32 to match the audio; with a plain int
+    # offset numpy would promote the int16 n_people to float64.
+    #
+    # To keep the number of passes over the samples down, this works in
+    # place, with global_volume folded into the other gains.  Both data and
+    # backing_data are overwritten.
     if not state.disable_auto_gain:
-        data *= ((1 + N_PHANTOM_PEOPLE) / (n_people + N_PHANTOM_PEOPLE)) ** 0.5
-    data += (
-        backing_data *
-        (state.backing_volume * (1 if state.bpm > 0 else 0.2)) *
-        user_backing_volume
-    )
-    data *= state.global_volume
+        gain = n_people + np.float32(N_PHANTOM_PEOPLE)
+        np.divide(1 + N_PHANTOM_PEOPLE, gain, out=gain)
+        np.sqrt(gain, out=gain)
+        gain *= state.global_volume
+        data *= gain
+    else:
+        data *= state.global_volume
+    backing_data *= (
+        state.backing_volume * (1 if state.bpm > 0 else 0.2) *
+        user_backing_volume * state.global_volume)
+    data += backing_data
     return data
 
 def get_telemetry():
@@ -921,7 +991,7 @@ def handle_special(query_params, server_clock, user=None, client_read_clock=None
 
 # Do some format conversions and strip the unnecessary nesting layer that urllib
 #   query parsing applies
-INT_PARAMS = ["write_clock", "read_clock", "bpm", "repeats", "bpr"]
+INT_PARAMS = {"write_clock", "read_clock", "bpm", "repeats", "bpr"}
 def clean_query_params(params):
     clean_params = {}
     for (k, v) in params.items():
@@ -988,12 +1058,8 @@ def handle_post(in_json, in_data) -> Tuple[Any, str]:
     #   so nothing has touched it yet "this time around".
     clear_samples = min(server_clock - state.last_request_clock, QUEUE_LENGTH)
     clear_index = state.last_request_clock
-    wrap_assign(
-        n_people_queue, clear_index, np.zeros(clear_samples, np.int16))
-    wrap_assign(
-        monitor_queue, clear_index, np.zeros(clear_samples, np.float32))
-    wrap_assign(
-        audio_queue, clear_index, np.zeros(clear_samples, np.float32))
+    wrap_zero(n_people_queue, clear_index, clear_samples)
+    wrap_zero(monitor_and_audio_queues, clear_index, clear_samples)
     state.last_cleared_clock = clear_index + clear_samples
 
     max_backing_track_samples = len(state.backing_track) - state.backing_track_index
@@ -1016,9 +1082,7 @@ def handle_post(in_json, in_data) -> Tuple[Any, str]:
         if state.bpm > 0:
             write_metronome(clear_index, clear_samples)
         else:
-            wrap_assign(
-                backing_queue, clear_index,
-                np.zeros(clear_samples, np.float32))
+            wrap_zero(backing_queue, clear_index, clear_samples)
 
     saved_last_request_clock = state.last_request_clock
     state.last_request_clock = server_clock
@@ -1168,9 +1232,13 @@ def handle_post(in_json, in_data) -> Tuple[Any, str]:
         if client_write_clock is not None:
             user.last_write_clock = client_write_clock
 
-        in_data *= user.scaled_mic_volume
+        # Fold all the gains into one scalar so we scale in_data in a
+        # single pass, and not at all in the common unity case.
+        gain = user.scaled_mic_volume
         if state.leader == user.userid:
-            in_data *= LEADER_BOOST
+            gain *= LEADER_BOOST
+        if gain != 1:
+            in_data *= gain
 
         # XXX: I'm not sure we consider this desirable for ritual engine?
         # Don't keep any input unless a song is in progress.
@@ -1182,8 +1250,9 @@ def handle_post(in_json, in_data) -> Tuple[Any, str]:
             update_audio(pos, n_samples, in_data, user.is_monitored)
 
             if state.bpr and state.bpm and state.repeats:
+                repeat_samples = repeat_length_samples()
                 for i in range(state.repeats):
-                    repeat_pos = pos + repeat_length_samples()*(i+1)
+                    repeat_pos = pos + repeat_samples*(i+1)
                     if repeat_pos + n_samples < server_clock:
                         update_audio(repeat_pos, n_samples, in_data, False)
 
@@ -1212,8 +1281,13 @@ def handle_post(in_json, in_data) -> Tuple[Any, str]:
     if query_params.get("loopback", None) == "true":
         data = in_data
     elif user.is_monitoring:
-        data = wrap_get(monitor_queue, client_read_clock - n_samples, n_samples)
+        data = wrap_get(monitor_queue, client_read_clock - n_samples, n_samples,
+                        out=get_scratch("data", n_samples, np.float32))
     else:
+        audio_and_backing = get_scratch(
+            "audio_and_backing", n_samples, np.float32, n_rows=2)
+        data, backing_data = audio_and_backing
+
         # Only play audio during songs.  Mostly this is dealt with by
         # only keeping input when a song is in progress, but the
         # metronome, backing track, and round singing are also forms
@@ -1221,16 +1295,14 @@ def handle_post(in_json, in_data) -> Tuple[Any, str]:
         if state.song_start_clock and (
                 not state.song_end_clock or
                 client_read_clock - n_samples < state.song_end_clock):
-            data = wrap_get(audio_queue, client_read_clock - n_samples,
-                            n_samples)
-            backing_data = wrap_get(backing_queue, client_read_clock - n_samples,
-                                    n_samples)
+            wrap_get(audio_and_backing_queues, client_read_clock - n_samples,
+                     n_samples, out=audio_and_backing)
         else:
-            data = np.zeros(n_samples, np.float32)
-            backing_data = np.zeros(n_samples, np.float32)
+            audio_and_backing.fill(0)
 
         n_people = wrap_get(
-            n_people_queue, client_read_clock - n_samples, n_samples)
+            n_people_queue, client_read_clock - n_samples, n_samples,
+            out=get_scratch("n_people", n_samples, np.int16))
 
         data = fix_volume(data, backing_data, n_people, user.backing_volume)
 
@@ -54,22 +54,18 @@ users = {}  # userid -> (enc, dec)
 #   whether we're in sharded mode or not.
 backend = None
 
+# big-endian
+#  2   packet length: uint16
+PACKET_LENGTH_FORMAT = struct.Struct(">H")
+
 def pack_multi(packets) -> Any:
-    encoded_length = 1
-    for p in packets:
-        encoded_length += 2 + len(p)
-    outdata = np.zeros(encoded_length, np.uint8)
-    outdata[0] = len(packets)
-    idx = 1
+    parts = [bytes((len(packets),))]
     for p in packets:
         if p.dtype != np.uint8:
             raise Exception("pack_multi only accepts uint8")
-        outdata[idx] = len(p) >> 8
-        outdata[idx + 1] = len(p) % 256
-        idx += 2
-        outdata[idx:idx+len(p)] = p
-        idx += len(p)
-    return outdata
+        parts.append(PACKET_LENGTH_FORMAT.pack(len(p)))
+        parts.append(p.tobytes())
+    return np.frombuffer(b"".join(parts), dtype=np.uint8)
 
 def unpack_multi(data) -> List[Any]:
     if data.dtype != np.uint8:
@@ -78,22 +74,24 @@ def unpack_multi(data) -> List[Any]:
     data_idx = 1
     result = []
     for i in range(packet_count):
-        length = (data[data_idx] << 8) + data[data_idx + 1]
-        data_idx += 2
+        length, = PACKET_LENGTH_FORMAT.unpack_from(data, data_idx)
+        data_idx += PACKET_LENGTH_FORMAT.size
         packet = data[data_idx:data_idx+length]
         data_idx += length
         result.append(packet)
     return result
 
 def calculate_volume(in_data):
-    return np.sqrt(np.mean(in_data**2))
+    # Sum of squares in a single pass, without materializing in_data**2.
+    return np.sqrt(np.dot(in_data, in_data) / len(in_data))
 
 def handle_post_special(query_string):
     data, x_audio_metadata = handle_json_post(np.zeros(0), query_string, {})
-    return data.tobytes(), x_audio_metadata
+    return [data.tobytes()], x_audio_metadata
 
 def handle_post(userid, n_samples, in_data_raw,
-                query_string, client_address=None) -> Tuple[Any, str]:
+                query_string, client_address=None,
+                query_params=None) -> Tuple[Any, str]:
     if not userid.isdigit():
         raise ValueError("UserID must be numeric; got: %r"%userid)
     try:
@@ -105,8 +103,10 @@ def handle_post(userid, n_samples, in_data_raw,
         users[userid] = enc, dec
 
     post_body = np.frombuffer(in_data_raw, dtype=np.uint8)
-    parsed_params = urllib.parse.parse_qs(query_string, strict_parsing=True)
-    json_len, = parsed_params.get("json_len", [None])
+    # do_POST has usually parsed the query string already.
+    if query_params is None:
+        query_params = urllib.parse.parse_qs(query_string, strict_parsing=True)
+    json_len, = query_params.get("json_len", [None])
     if json_len:
         json_len = int(json_len)
         json_kvs = json.loads(post_body[:json_len].tobytes().decode('utf8'))
@@ -145,7 +145,8 @@ def handle_post(userid, n_samples, in_data_raw,
         client_address=client_address)
 
     # Divide data into user_summary and raw audio data
-    n_users_in_summary, = struct.unpack(">H", data[:2])
+    n_users_in_summary, = server.BINARY_USER_SUMMARY_HEADER_FORMAT.unpack_from(
+        data)
     user_summary_n_bytes = server.summary_length(n_users_in_summary)
 
     user_summary = data[:user_summary_n_bytes]
@@ -159,15 +160,16 @@ def handle_post(userid, n_samples, in_data_raw,
         encoded.append(e)
     compressed_audio = pack_multi(encoded)
 
-    # Combine user_summary and compressed audio data
-    data = np.append(user_summary, compressed_audio)
+    # Send user_summary and compressed audio data as separate chunks of the
+    #   response, instead of copying them together first.
+    data = [user_summary.tobytes(), compressed_audio.tobytes()]
 
     with open(os.path.join(LOG_DIR, userid), "a") as log_file:
         log_file.write("%d %.8f\n"%(
             time.time(),
             -1 if client_no_data else rms_volume))
 
-    return data.tobytes(), x_audio_metadata
+    return data, x_audio_metadata
 
 def handle_json_post(in_data, query_string, json_kvs, client_address=None):
     json_kvs.update({
@@ -207,6 +209,15 @@ def do_OPTIONS(environ, start_response) -> None:
          ("Access-Control-Max-Age", "86400")])
     return b'',
 
+# Everything in the GET response's metadata except the clock is fixed at
+#   startup, so encode it once.  This produces the same string as running
+#   json.dumps on the whole dict for every request.
+GET_X_AUDIO_METADATA_TEMPLATE = '{"server_clock": %d, ' + json.dumps({
+    "server_sample_rate": server.SAMPLE_RATE,
+    "server_version": server.SERVER_VERSION,
+    "server_branch": server.SERVER_BRANCH,
+})[1:].replace("%", "%%")
+
 # GET requests do not require any specific parameters. Primarily they are used
 #   when a client is starting up, to retrieve the server's current time. The
 #   use of them to start and stop profiling is kind of gross and should really
@@ -241,16 +252,15 @@ def do_GET(environ, start_response) -> None:
         [("Access-Control-Allow-Origin", "*"),
          ("Access-Control-Max-Age", "86400"),
          ("Access-Control-Expose-Headers", "X-Audio-Metadata"),
-         ("X-Audio-Metadata", json.dumps({
-             "server_clock": server_clock,
-             "server_sample_rate": server.SAMPLE_RATE,
-             "server_version": server.SERVER_VERSION,
-             "server_branch": server.SERVER_BRANCH,
-         })),
+         ("X-Audio-Metadata", GET_X_AUDIO_METADATA_TEMPLATE % server_clock),
          ("Content-Type", "application/octet-stream")])
     # If we give a 0-byte response, Chrome Dev Tools gives a misleading error (see https://stackoverflow.com/questions/57477805/why-do-i-get-fetch-failed-loading-when-it-actually-worked)
     return b'ok',
 
+# What json.dumps({"metadata_len": N}) would produce; this header has a fixed
+#   schema, so there is no need to run the general-purpose encoder for it.
+SIMPLE_X_AUDIO_METADATA_TEMPLATE = '{"metadata_len": %d}'
+
 # POST requests absolutely must have a numeric user_id for all requests which
 #   make it as far as handle_post; such requests must be associated with a user
 #   or there's nothing we can do with them, and they will fail.
@@ -289,7 +299,7 @@ def do_POST(environ, start_response) -> None:
             del users[userid]
 
         if userid is not None:
-            data, x_audio_metadata = handle_post(userid, n_samples, in_data_raw, query_string, client_address=client_address)
+            data, x_audio_metadata = handle_post(userid, n_samples, in_data_raw, query_string, client_address=client_address, query_params=query_params)
         else:
             data, x_audio_metadata = handle_post_special(query_string)
     except Exception as e:
@@ -300,11 +310,10 @@ def do_POST(environ, start_response) -> None:
         print("Request raised exception!\nParams:", query_string, "\n", traceback.format_exc(), file=sys.stderr)
         return util.die500(start_response, e)
 
-    combined_data = x_audio_metadata.encode('utf-8') + data
+    response_chunks = [x_audio_metadata.encode('utf-8')] + data
 
-    simple_x_audio_metadata = json.dumps({
-        "metadata_len": len(x_audio_metadata)
-    })
+    simple_x_audio_metadata = SIMPLE_X_AUDIO_METADATA_TEMPLATE % (
+        len(x_audio_metadata))
 
     start_response(
         '200 OK',
@@ -312,8 +321,18 @@ def do_POST(environ, start_response) -> None:
          ("Access-Control-Max-Age", "86400"),
          ("Access-Control-Expose-Headers", "X-Audio-Metadata"),
          ("X-Audio-Metadata", simple_x_audio_metadata),
-         ("Content-Type", "application/octet-stream")])
-    return combined_data,
+         ("Content-Type", "application/octet-stream"),
+         # The server can only work this out for itself when the response
+         #   is a single chunk.
+         ("Content-Length",
+          str(sum(len(chunk) for chunk in response_chunks)))])
+    return response_chunks
+
+REQUEST_HANDLERS = {
+    "GET": do_GET,
+    "POST": do_POST,
+    "OPTIONS": do_OPTIONS,
+}
 
 def application(environ, start_response):
     global backend
@@ -328,10 +347,8 @@ def application(environ, start_response):
     if backend is None:
         backend = shm.FakeClient()
 
-    return {"GET": do_GET,
-            "POST": do_POST,
-            "OPTIONS": do_OPTIONS}[environ["REQUEST_METHOD"]](
-                environ, start_response)
+    return REQUEST_HANDLERS[environ["REQUEST_METHOD"]](
+        environ, start_response)
 
 def serve():
     from wsgiref.simple_server import make_server
@@ -21,7 +21,10 @@ MESSAGE_TYPE_RESPONSE = 2
 #   N bytes: data
 MAX_JSON_LENGTH = 10000
 MAX_DATA_LENGTH = 199998
-BUFFER_SIZE = 1 + 2 + MAX_JSON_LENGTH + 4 + MAX_DATA_LENGTH
+JSON_LENGTH_FORMAT = struct.Struct("H")
+DATA_LENGTH_FORMAT = struct.Struct("I")
+BUFFER_SIZE = (1 + JSON_LENGTH_FORMAT.size + MAX_JSON_LENGTH +
+               DATA_LENGTH_FORMAT.size + MAX_DATA_LENGTH)
 
 def attach_or_create(name):
     name = "shm://" + name
@@ -56,22 +59,22 @@ def encode_json_and_data(buf, json_raw, data, throw_exceptions):
             json_raw_bytes = json.dumps({"error": errormsg}).encode("utf-8")
             data = np.zeros(0, dtype=np.uint8)
 
-    buf[index : index + 2] = memoryview(struct.pack("H", len(json_raw_bytes)))
-    index += 2
+    JSON_LENGTH_FORMAT.pack_into(buf, index, len(json_raw_bytes))
+    index += JSON_LENGTH_FORMAT.size
 
     buf[index : index + len(json_raw_bytes)] = memoryview(json_raw_bytes)
     index += len(json_raw_bytes)
 
-    buf[index : index + 4] = memoryview(struct.pack("I", len(data)))
-    index += 4
+    DATA_LENGTH_FORMAT.pack_into(buf, index, len(data))
+    index += DATA_LENGTH_FORMAT.size
 
     buf[index : index + len(data)] = data
 
 def decode_json_and_data(buf):
     index = 1
 
-    json_length, = buf[index : index + 2].view(dtype=np.uint16)
-    index += 2
+    json_length, = JSON_LENGTH_FORMAT.unpack_from(buf, index)
+    index += JSON_LENGTH_FORMAT.size
 
     if json_length > MAX_JSON_LENGTH:
         raise Exception("bad json length %s" % json_length)
@@ -79,8 +82,8 @@ def decode_json_and_data(buf):
     json_raw = buf[index : index + json_length].tobytes()
     index += json_length
 
-    data_length, = buf[index : index + 4].view(dtype=np.uint32)
-    index += 4
+    data_length, = DATA_LENGTH_FORMAT.unpack_from(buf, index)
+    index += DATA_LENGTH_FORMAT.size
 
     if data_length > MAX_DATA_LENGTH:
         raise Exception("bad data length %s" % data_length)
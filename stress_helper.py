@@ -50,7 +50,13 @@ def stress(n_rounds, users_per_client, worker_name, url, should_sleep):
         np.uint8)
       for packet in audio_packets]).tobytes()
 
+  # One keep-alive session for the whole run, with the headers set once,
+  # so we measure the server and not connection setup.
   s = requests.Session()
+  s.headers.update({
+      'Content-Type': 'application/octet-stream',
+      'Accept-Encoding': 'gzip',
+  })
 
   userid = int(random.random()*10000000)
   timing = []
@@ -63,11 +69,7 @@ def stress(n_rounds, users_per_client, worker_name, url, should_sleep):
     resp = s.post(
       url='%s?read_clock=%s&write_clock=%s&userid=%s%s&username=%s'
         % (url, ts, ts - (READ_WRITE_OFFSET * server.SAMPLE_RATE), userid, i%users_per_client, worker_name),
-      data=data,
-      headers={
-          'Content-Type': 'application/octet-stream',
-          'Accept-Encoding': 'gzip',
-      })
+      data=data)
     if resp.status_code != 200:
       print("got: %s (%s)" % (resp.status_code, resp.content))
 
@@ -11,7 +11,7 @@ PACKET_SAMPLES = int(server.SAMPLE_RATE * PACKET_INTERVAL)
 
 enc = opuslib.Encoder(
   server.SAMPLE_RATE, server_wrapper.CHANNELS, opuslib.APPLICATION_AUDIO)
-zeros = np.zeros(PACKET_SAMPLES).reshape(
+zeros = np.zeros(PACKET_SAMPLES, np.float32).reshape(
   [-1, server_wrapper.OPUS_FRAME_SAMPLES])
 
 data = server_wrapper.pack_multi([